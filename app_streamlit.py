@@ -1,18 +1,294 @@
+import copy
+import functools
+import gc
+import importlib.metadata
+import importlib.util
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
 import streamlit as st
-from transformers import pipeline, set_seed
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    BitsAndBytesConfig,
+    LogitsProcessorList,
+    MinNewTokensLengthLogitsProcessor,
+    NoRepeatNGramLogitsProcessor,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+    set_seed,
+)
+from transformers.pytorch_utils import Conv1D
 import torch # Good to import explicitly if checking for GPU
 
+# Small model sharing GPT-2's tokenizer, used to draft tokens for speculative decoding
+DRAFT_MODEL_NAME = "distilgpt2"
+# Every prompt reads f"{PROMPT_PREFIX} {topic}{PROMPT_SUFFIX}". Both fixed parts are tokenized once at load
+# time and the prefix's key/value cache is computed once as well.
+# (No trailing space: GPT-2's tokenizer attaches the space to the topic's first token.)
+PROMPT_PREFIX = "Compose a short, creative poem about"
+PROMPT_SUFFIX = ":\n\n"
+# Where exported, optimized and quantized ONNX models are kept between app restarts
+ONNX_CACHE_DIR = "onnx_models"
+# Requests arriving within this window (from any browser session) share one generate call
+BATCH_WINDOW_SECONDS = 0.02
+# Upper bound on rows per batch, to limit compute wasted on padding
+MAX_BATCH_SIZE = 8
+# vLLM pages its KV cache instead of padding, so it can take far more concurrent sequences per step
+VLLM_MAX_NUM_SEQS = 32
+# The vLLM release the vLLM backend is written against (pinned in requirements-vllm.txt)
+VLLM_VERSION = "0.6.3"
+# Poems get at least this many new tokens before EOS is allowed (capped at the requested length)
+MIN_NEW_TOKENS = 10
+# Where weights that fit neither in GPU memory nor in CPU RAM are offloaded to
+OFFLOAD_DIR = "offload"
+
+# --- Helper Functions to Load Models with Quantized Weights ---
+def _is_installed(*package_names):
+    """Checks whether the given optional packages can be imported."""
+    return all(importlib.util.find_spec(name) is not None for name in package_names)
+
+
+def _conv1d_to_linear(model):
+    """Swaps GPT-2's Conv1D layers for equivalent nn.Linear ones so dynamic quantization picks them up."""
+    for parent in list(model.modules()):
+        for name, child in parent.named_children():
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(parent, name, linear)
+    return model
+
+
+def _max_memory():
+    """Memory budget for device_map="auto": 90% of GPU 0, leaving room for activations and the KV cache."""
+    from accelerate.utils import get_max_memory
+
+    max_memory = get_max_memory()
+    max_memory[0] = int(max_memory[0] * 0.9)
+    return max_memory
+
+
+def _is_offloaded(model):
+    """Checks whether device_map="auto" placed any of the model's weights on CPU or disk."""
+    return any(device in ("cpu", "disk") for device in getattr(model, "hf_device_map", {}).values())
+
+
+def _attention_implementation(device):
+    """
+    Picks a fused attention kernel that never materializes the full attention matrix:
+    FlashAttention-2 on Ampere or newer GPUs with flash-attn installed, PyTorch's SDPA otherwise.
+    """
+    if device == "cuda" and _is_installed("flash_attn") and torch.cuda.get_device_capability()[0] >= 8:
+        return "flash_attention_2"
+    return "sdpa"
+
+
+def load_causal_lm(model_name, device):
+    """
+    Loads a causal language model with quantized weights and fused attention.
+    On GPU this uses bitsandbytes 4-bit NF4 weights (dequantized on the fly, matmuls in BF16/FP16)
+    when it is installed, on CPU PyTorch's dynamic quantization, which runs INT8 GEMMs through oneDNN.
+    """
+    attn_implementation = _attention_implementation(device)
+    if device == "cuda":
+        # Half-precision weights halve the bytes moved per matmul; BF16 needs Ampere or newer
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        if not _is_installed("accelerate"):
+            # device_map placement, CPU offload and bitsandbytes loading all need accelerate
+            print(f"accelerate not installed, loading {dtype} weights onto the GPU without offloading.")
+            return AutoModelForCausalLM.from_pretrained(
+                model_name, torch_dtype=dtype, attn_implementation=attn_implementation
+            ).to(device).eval()
+        if not _is_installed("bitsandbytes"):
+            print(f"bitsandbytes not installed, loading {dtype} weights.")
+            # Models too large for the GPU keep their overflow on CPU (or disk) and stream it in as needed
+            return AutoModelForCausalLM.from_pretrained(
+                model_name,
+                torch_dtype=dtype,
+                attn_implementation=attn_implementation,
+                device_map="auto",
+                max_memory=_max_memory(),
+                offload_folder=OFFLOAD_DIR
+            ).eval()
+        return AutoModelForCausalLM.from_pretrained(
+            model_name,
+            quantization_config=BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=dtype,
+                bnb_4bit_use_double_quant=True,
+                # Lets device_map="auto" keep layers that don't fit on the GPU unquantized on the CPU
+                llm_int8_enable_fp32_cpu_offload=True
+            ),
+            torch_dtype=dtype, # Used for the layers bitsandbytes leaves unquantized
+            attn_implementation=attn_implementation,
+            device_map="auto",
+            max_memory=_max_memory(),
+            offload_folder=OFFLOAD_DIR
+        ).eval()
+
+    model = AutoModelForCausalLM.from_pretrained(model_name, attn_implementation=attn_implementation)
+    model = _conv1d_to_linear(model.eval())
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_onnx_causal_lm(model_name):
+    """
+    Loads a causal language model as an ONNX Runtime session for CPU inference.
+    The model is exported once, graph-optimized (attention/GELU/LayerNorm fusions) and
+    dynamically quantized to INT8; later loads reuse the files in ONNX_CACHE_DIR.
+    """
+    from optimum.onnxruntime import ORTModelForCausalLM, ORTOptimizer, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig, OptimizationConfig
+
+    save_dir = os.path.join(ONNX_CACHE_DIR, model_name)
+    quantized_file = "model_optimized_quantized.onnx"
+    if not os.path.exists(os.path.join(save_dir, quantized_file)):
+        print(f"Exporting '{model_name}' to ONNX (first run only)...")
+        ort_model = ORTModelForCausalLM.from_pretrained(model_name, export=True, provider="CPUExecutionProvider")
+        optimizer = ORTOptimizer.from_pretrained(ort_model)
+        optimizer.optimize(
+            save_dir=save_dir,
+            optimization_config=OptimizationConfig(optimization_level=99, optimize_for_gpu=False, fp16=False)
+        )
+        quantizer = ORTQuantizer.from_pretrained(save_dir, file_name="model_optimized.onnx")
+        quantizer.quantize(
+            save_dir=save_dir,
+            quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        )
+    return ORTModelForCausalLM.from_pretrained(save_dir, file_name=quantized_file, provider="CPUExecutionProvider")
+
+
+@functools.lru_cache(maxsize=None)
+def _vllm_supported():
+    """Checks that the pinned vLLM release is installed; other releases changed the APIs used here."""
+    if not _is_installed("vllm"):
+        return False
+    installed = importlib.metadata.version("vllm")
+    if installed.split("+")[0] != VLLM_VERSION:
+        print(f"vLLM {installed} installed, but the vLLM backend needs {VLLM_VERSION}; using transformers instead.")
+        return False
+    return True
+
+
+def load_vllm_engine(model_name):
+    """
+    Loads the model into a vLLM engine for GPU serving. PagedAttention lets requests of different
+    lengths share each decode step without padding, and prefix caching reuses the prompt prefix's KV blocks.
+    """
+    from vllm import LLM
+
+    return LLM(
+        model=model_name,
+        dtype="bfloat16" if torch.cuda.is_bf16_supported() else "float16",
+        max_num_seqs=VLLM_MAX_NUM_SEQS,
+        enable_prefix_caching=True
+    )
+
+
+def _select_backend(device):
+    """Picks how the model is served: vLLM on GPU or ONNX Runtime on CPU when available, transformers otherwise."""
+    if device == "cuda" and _vllm_supported():
+        return "vllm"
+    if device == "cpu" and _is_installed("optimum", "onnxruntime"):
+        return "onnxruntime"
+    return "torch"
+
+
+def _supports_compile():
+    """torch.compile is only reliable enough for generation from PyTorch 2.1 on."""
+    major, minor = (int(part) for part in torch.__version__.split(".")[:2])
+    return (major, minor) >= (2, 1)
+
+
+@st.cache_resource
+def _active_generators():
+    """Process-wide record of loaded generators (model_name -> generator), shared by all sessions."""
+    return {}
+
+
+def _shutdown_generator(generator):
+    """Stops a generator's worker once its queued requests are served, then releases the model's memory."""
+    # Under the lock no request can be queued behind the exit marker, where nobody would ever serve it
+    with generator["lock"]:
+        generator["closed"] = True
+        generator["queue"].put(None) # Tells the worker to exit
+    generator["worker"].join()
+    generator.clear()
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
 # --- Helper Function to Load Model (for Caching) ---
 # @st.cache_resource is used to cache resources like models so they don't reload on every interaction.
-@st.cache_resource
+# Only one model is kept resident and it is shared by every session: loading another one shuts the
+# previous one down first. Sessions follow the resident model and only switch it when their user picks
+# another model in the sidebar, so sessions with different earlier choices don't keep reloading each other's.
+@st.cache_resource(max_entries=1)
 def load_generator_pipeline(model_name="gpt2"):
-    """Loads and caches the Hugging Face pipeline."""
+    """
+    Loads and caches the model, its draft model and the tokenizer.
+    On GPU the model is served through vLLM when it is installed, on CPU through ONNX Runtime
+    when optimum is installed; those backends have no draft model or prefix cache,
+    since both rely on PyTorch modules.
+    """
     print(f"Loading model: {model_name}...") # This will print to your console, not the web UI
     # Check for GPU availability
-    device = 0 if torch.cuda.is_available() else -1 # 0 for GPU, -1 for CPU
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    active_generators = _active_generators()
+    for previous_name in list(active_generators):
+        print(f"Unloading model: {previous_name}...")
+        _shutdown_generator(active_generators.pop(previous_name))
     try:
-        generator = pipeline('text-generation', model=model_name, device=device)
-        print(f"Model '{model_name}' loaded successfully on {'GPU' if device == 0 else 'CPU'}.")
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # GPT-2 has no pad token; pad batched prompts on the left so generation continues right after them
+        tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+        prefix_ids = tokenizer(PROMPT_PREFIX).input_ids
+        suffix_ids = tokenizer(PROMPT_SUFFIX).input_ids
+        backend = _select_backend(device)
+        if backend == "vllm":
+            model = load_vllm_engine(model_name)
+            draft_model, prefix_past = None, None
+        elif backend == "onnxruntime":
+            model = load_onnx_causal_lm(model_name)
+            draft_model, prefix_past = None, None
+        else:
+            model = load_causal_lm(model_name, device)
+            # The draft model proposes a few tokens at a time, which the main model then verifies in a single forward pass
+            draft_model = load_causal_lm(DRAFT_MODEL_NAME, device)
+            # Run the shared prompt prefix through the model once so requests only prefill the topic part.
+            # This runs eagerly, before compiling, so the long-lived cache is never a compiled-graph output.
+            with torch.inference_mode():
+                prefix_past = model(torch.tensor([prefix_ids], device=device), use_cache=True).past_key_values
+            if (device == "cuda" and _supports_compile() and not getattr(model, "is_loaded_in_4bit", False)
+                    and not _is_offloaded(model)):
+                # TorchInductor fuses elementwise/norm ops and uses SDPA kernels. The first generation pays
+                # the compile cost (cached by @st.cache_resource); generate() still calls the compiled forward.
+                # The default mode avoids CUDA graphs: the key/value cache grows every step, so graphs would be
+                # re-recorded per step and their outputs overwritten by later replays.
+                model.forward = torch.compile(model.forward, mode="default", dynamic=True)
+        stanza_tables = _build_stanza_tables(tokenizer, device)
+        print(f"Model '{model_name}' loaded successfully on {device.upper()} ({backend} backend"
+              f"{f', draft: {DRAFT_MODEL_NAME}' if draft_model is not None else ''}).")
+        generator = {"model": model, "draft_model": draft_model, "tokenizer": tokenizer, "device": device,
+                     "backend": backend,
+                     "prefix_ids": prefix_ids, "suffix_ids": suffix_ids, "prefix_past": prefix_past,
+                     "stanza_tables": stanza_tables, "queue": queue.Queue(), "lock": threading.Lock(), "closed": False}
+        # A single background thread owns the model and serves the requests of every session
+        generator["worker"] = threading.Thread(target=_batch_worker, args=(generator,), name="poem-batcher", daemon=True)
+        generator["worker"].start()
+        _warm_up(generator)
+        active_generators[model_name] = generator
         return generator
     except Exception as e:
         # If model loading fails, display an error in Streamlit and stop.
@@ -21,46 +297,478 @@ def load_generator_pipeline(model_name="gpt2"):
         return None
 
 
-# --- Your Original Poem Generation Logic (slightly adapted) ---
-def generate_poem_for_streamlit(generator_pipeline, topic, max_len=60, num_poems=1, temperature=0.7, num_beams=5, seed_value=42):
+# --- Beam Search with a Shared Prompt Cache ---
+def _cache_length(past_key_values):
+    """Returns the number of positions held in a key/value cache (0 for no cache)."""
+    if past_key_values is None:
+        return 0
+    if hasattr(past_key_values, "get_seq_length"):
+        return past_key_values.get_seq_length()
+    return past_key_values[0][0].shape[-2]
+
+
+def _select_cache_rows(past_key_values, row_indices):
+    """Gathers the given batch rows of a key/value cache (rows may repeat)."""
+    if hasattr(past_key_values, "reorder_cache"):
+        past_key_values.reorder_cache(row_indices)
+        return past_key_values
+    return tuple(tuple(t.index_select(0, row_indices) for t in layer) for layer in past_key_values)
+
+
+@torch.inference_mode()
+def _beam_generate(model, input_ids, past_key_values, num_beams, max_new_tokens, min_new_tokens=MIN_NEW_TOKENS,
+                   no_repeat_ngram_size=2, eos_token_id=None, num_return_sequences=1):
     """
-    Generates poem(s) using the provided pipeline and parameters.
-    Returns a list of poem strings.
+    Beam search for a single prompt (batch size one).
+    The prompt's key/value cache stays at batch size one until the first beams are chosen,
+    and afterwards only the rows of the surviving beams are gathered each step.
+    Banned n-grams are kept per beam and updated incrementally instead of rescanning the sequence.
+    Returns the generated token ids of the best hypotheses, best first.
     """
-    if generator_pipeline is None:
-        return ["Error: Model pipeline not available."]
+    n = no_repeat_ngram_size
+    device = input_ids.device
+    prompt_tokens = input_ids[0].tolist()
+    prompt_ngrams = {}
+    if n > 0:
+        for i in range(len(prompt_tokens) - n + 1):
+            key = tuple(prompt_tokens[i:i + n - 1])
+            prompt_ngrams[key] = prompt_ngrams.get(key, frozenset()) | {prompt_tokens[i + n - 1]}
+
+    # attention_mask and position_ids are always passed: the ONNX export of GPT-2 requires both inputs
+    cached_length = _cache_length(past_key_values)
+    prompt_length = input_ids.shape[1]
+    outputs = model(
+        input_ids[:, cached_length:],
+        attention_mask=torch.ones(1, prompt_length, dtype=torch.long, device=device),
+        position_ids=torch.arange(cached_length, prompt_length, device=device).unsqueeze(0),
+        past_key_values=past_key_values,
+        use_cache=True
+    )
+    past = outputs.past_key_values
+    logits = outputs.logits[:, -1, :]
+    beam_seqs = [prompt_tokens]
+    beam_ngrams = [prompt_ngrams]
+    beam_scores = torch.zeros(1, device=device)
+    finished = [] # (length-normalized score, generated tokens)
+
+    for step in range(max_new_tokens):
+        log_probs = torch.log_softmax(logits.float(), dim=-1)
+        if eos_token_id is not None and step < min_new_tokens:
+            log_probs[:, eos_token_id] = -float("inf")
+        if n > 0:
+            for row, seq in enumerate(beam_seqs):
+                banned = beam_ngrams[row].get(tuple(seq[len(seq) - (n - 1):]))
+                if banned:
+                    log_probs[row, list(banned)] = -float("inf")
+
+        # Twice as many candidates as beams, so beams ending in EOS don't starve the search
+        vocab_size = log_probs.shape[-1]
+        top_scores, top_ids = torch.topk((beam_scores.unsqueeze(-1) + log_probs).view(-1), 2 * num_beams)
+        next_rows, next_tokens, next_scores = [], [], []
+        for score, flat_id in zip(top_scores.tolist(), top_ids.tolist()):
+            row, token = divmod(flat_id, vocab_size)
+            if token == eos_token_id:
+                generated = beam_seqs[row][len(prompt_tokens):]
+                finished.append((score / (len(generated) + 1), generated))
+                continue
+            next_rows.append(row)
+            next_tokens.append(token)
+            next_scores.append(score)
+            if len(next_rows) == num_beams:
+                break
+
+        new_seqs, new_ngrams = [], []
+        for row, token in zip(next_rows, next_tokens):
+            seq = beam_seqs[row]
+            ngrams = beam_ngrams[row]
+            if n > 0:
+                key = tuple(seq[len(seq) - (n - 1):])
+                ngrams = dict(ngrams)
+                ngrams[key] = ngrams.get(key, frozenset()) | {token}
+            new_seqs.append(seq + [token])
+            new_ngrams.append(ngrams)
+        beam_seqs, beam_ngrams = new_seqs, new_ngrams
+        beam_scores = torch.tensor(next_scores, device=device)
+
+        if len(finished) >= num_beams or step + 1 == max_new_tokens:
+            break
+        past = _select_cache_rows(past, torch.tensor(next_rows, device=device))
+        sequence_length = len(beam_seqs[0])
+        outputs = model(
+            torch.tensor(next_tokens, device=device).unsqueeze(-1),
+            attention_mask=torch.ones(len(next_tokens), sequence_length, dtype=torch.long, device=device),
+            position_ids=torch.full((len(next_tokens), 1), sequence_length - 1, device=device),
+            past_key_values=past,
+            use_cache=True
+        )
+        past = outputs.past_key_values
+        logits = outputs.logits[:, -1, :]
+
+    for seq, score in zip(beam_seqs, beam_scores.tolist()):
+        generated = seq[len(prompt_tokens):]
+        finished.append((score / max(len(generated), 1), generated))
+    finished.sort(key=lambda hypothesis: hypothesis[0], reverse=True)
+    return [generated for _, generated in finished[:num_return_sequences]]
 
-    try:
-        set_seed(seed_value) # Set seed for reproducibility
 
-        prompt = f"Compose a short, creative poem about {topic}:\n\n"
+# --- Stopping at the End of the First Stanza ---
+# Poems are cut at their first blank line ("\n\n") after some text, so generation can stop there.
+def _build_stanza_tables(tokenizer, device):
+    """Precomputes per-token flags used to spot the first stanza boundary with tensor lookups."""
+    token_texts = tokenizer.batch_decode([[token_id] for token_id in range(len(tokenizer))])
 
-        generated_texts = generator_pipeline(
-            prompt,
-            max_length=max_len + len(prompt.split()),
-            min_length=10 + len(prompt.split()),
-            num_return_sequences=num_poems,
-            num_beams=num_beams,
+    def flags(predicate):
+        return torch.tensor([predicate(text) for text in token_texts], dtype=torch.bool, device=device)
+
+    return {
+        "content": flags(lambda text: text.strip() != ""),
+        "blank_line": flags(lambda text: "\n\n" in text),
+        "blank_line_after_text": flags(lambda text: "\n\n" in text.lstrip()),
+        "starts_newline": flags(lambda text: text.startswith("\n")),
+        "ends_newline": flags(lambda text: text.endswith("\n")),
+    }
+
+
+def _stanza_finished(generated_ids, tables):
+    """Flags the rows of generated token ids that already contain a blank line following some text."""
+    content = tables["content"][generated_ids]
+    content_before = (content.cumsum(dim=-1) - content.int()) > 0
+    blank_line = tables["blank_line"][generated_ids]
+    blank_line[:, 1:] |= tables["ends_newline"][generated_ids[:, :-1]] & tables["starts_newline"][generated_ids[:, 1:]]
+    boundary = tables["blank_line_after_text"][generated_ids] | (blank_line & content_before)
+    return boundary.any(dim=-1)
+
+
+class StanzaStoppingCriteria(StoppingCriteria):
+    """Stops rows of a generate() call once their first stanza is complete."""
+
+    def __init__(self, prompt_length, tables):
+        self.prompt_length = prompt_length
+        self.tables = tables
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return _stanza_finished(input_ids[:, self.prompt_length:], self.tables)
+
+
+@torch.inference_mode()
+def _sample_generate(model, input_ids, attention_mask, logits_processor, max_new_tokens, eos_token_id, tables,
+                     row_generators):
+    """
+    Samples continuations for a batch of left-padded prompts.
+    Each row draws its tokens from its own entry in row_generators (rows may share a torch.Generator),
+    so a row's samples don't depend on the other rows in the batch.
+    Rows that emit EOS or finish their first stanza are dropped from the batch (ids, attention mask
+    and key/value cache), so the remaining steps only run on the rows still generating.
+    Returns the generated token ids of every row.
+    """
+    prompt_length = input_ids.shape[1]
+    generated = [[] for _ in range(input_ids.shape[0])]
+    active_rows = torch.arange(input_ids.shape[0], device=input_ids.device)
+    sequences = input_ids
+    position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+    outputs = model(input_ids, attention_mask=attention_mask, position_ids=position_ids, use_cache=True)
+    past = outputs.past_key_values
+    logits = outputs.logits[:, -1, :]
+    next_positions = position_ids[:, -1:] + 1
+
+    for step in range(max_new_tokens):
+        scores = logits_processor(sequences, logits.float())
+        probs = torch.softmax(scores, dim=-1)
+        next_tokens = torch.stack([
+            torch.multinomial(probs[i], num_samples=1, generator=row_generators[row])
+            for i, row in enumerate(active_rows.tolist())
+        ])
+        sequences = torch.cat([sequences, next_tokens], dim=-1)
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones(attention_mask.shape[0], 1)], dim=-1)
+        for row, token in zip(active_rows.tolist(), next_tokens[:, 0].tolist()):
+            generated[row].append(token)
+
+        done = (next_tokens[:, 0] == eos_token_id) | _stanza_finished(sequences[:, prompt_length:], tables)
+        if done.all() or step + 1 == max_new_tokens:
+            break
+        if done.any():
+            keep = (~done).nonzero(as_tuple=True)[0]
+            active_rows, sequences, attention_mask, next_tokens, next_positions = (
+                t.index_select(0, keep) for t in (active_rows, sequences, attention_mask, next_tokens, next_positions)
+            )
+            past = _select_cache_rows(past, keep)
+
+        outputs = model(next_tokens, attention_mask=attention_mask, position_ids=next_positions,
+                        past_key_values=past, use_cache=True)
+        past = outputs.past_key_values
+        logits = outputs.logits[:, -1, :]
+        next_positions = next_positions + 1
+
+    return generated
+
+
+# --- vLLM Backend ---
+def _no_repeat_bigram_processor(prompt):
+    """
+    vLLM logits processor banning tokens that would repeat a bigram, like no_repeat_ngram_size=2 elsewhere.
+    The prompt's bigrams are indexed once per request (previous token -> banned next tokens); per step only
+    the output tokens are scanned, since one processor is shared by all samples of a request.
+    """
+    prompt_bigrams = {}
+    for previous, token in zip(prompt, prompt[1:]):
+        prompt_bigrams.setdefault(previous, set()).add(token)
+
+    def processor(output_token_ids, logits):
+        sequence = [prompt[-1]] + list(output_token_ids)
+        last = sequence[-1]
+        banned = set(prompt_bigrams.get(last, ()))
+        banned.update(token for previous, token in zip(sequence, sequence[1:]) if previous == last)
+        if banned:
+            logits[list(banned)] = -float("inf")
+        return logits
+    return processor
+
+
+def _generate_vllm(generator, requests):
+    """
+    Runs a window of (prompt, params, num_poems) requests through vLLM in one call, each with its own
+    sampling parameters, and returns the decoded continuations per request. Each request becomes a single
+    vLLM request with num_poems samples (or beam hypotheses), so its poems share one seeded sampling run.
+    Sampled requests get the same minimum length and bigram blocking as the other backends. vLLM 0.6.3's
+    beam_search takes neither logits processors nor min_tokens, so beam requests here have neither.
+    """
+    from vllm import SamplingParams
+    from vllm.sampling_params import BeamSearchParams
+
+    llm = generator["model"]
+    sampled = [request for request in requests if request[1][3] == 1]
+    beamed = [request for request in requests if request[1][3] > 1]
+
+    outputs = {}
+    if sampled:
+        sampling_params = []
+        for prompt, (max_len, temperature, seed_value, _), num_poems in sampled:
+            # vLLM rejects min_tokens > max_tokens
+            sampling_params.append(SamplingParams(
+                n=num_poems,
+                max_tokens=max_len,
+                min_tokens=min(MIN_NEW_TOKENS, max_len),
+                temperature=temperature,
+                top_k=50,
+                top_p=0.95,
+                seed=seed_value,
+                logits_processors=[_no_repeat_bigram_processor(prompt)]
+            ))
+        results = llm.generate([{"prompt_token_ids": list(prompt)} for prompt, _, _ in sampled], sampling_params, use_tqdm=False)
+        for request, result in zip(sampled, results):
+            outputs[id(request)] = [list(completion.token_ids) for completion in result.outputs]
+    for request in beamed:
+        prompt, (max_len, _, _, num_beams), num_poems = request
+        # vLLM 0.6.3's beam_search takes str or token-id list prompts (not the dict prompts generate() accepts)
+        # together with a BeamSearchParams
+        result = llm.beam_search(
+            [list(prompt)],
+            BeamSearchParams(beam_width=max(num_beams, num_poems), max_tokens=max_len)
+        )[0]
+        # Beam search sequences include the prompt tokens
+        outputs[id(request)] = [sequence.tokens[len(prompt):] for sequence in result.sequences[:num_poems]]
+
+    tokenizer = generator["tokenizer"]
+    return [tokenizer.batch_decode(outputs[id(request)], skip_special_tokens=True) for request in requests]
+
+
+# --- Micro-Batching of Concurrent Requests ---
+# Inference mode skips autograd bookkeeping (graph nodes, version counters) for every op, generate() included
+@torch.inference_mode()
+def _generate_batch(generator, requests, max_len, temperature, seed_value, num_beams):
+    """
+    Generates num_poems continuations for each (prompt, num_poems) request, where prompts are tuples
+    of token ids, and returns the decoded continuations per request.
+    """
+    model = generator["model"]
+    tokenizer = generator["tokenizer"]
+    device = generator["device"]
+
+    if num_beams > 1:
+        # Beam search is deterministic, so a request's poems are the best hypotheses of a single search
+        return [
+            tokenizer.batch_decode(_beam_generate(
+                model,
+                torch.tensor([prompt], device=device),
+                copy.deepcopy(generator["prefix_past"]),
+                num_beams=max(num_beams, num_poems),
+                max_new_tokens=max_len,
+                min_new_tokens=min(MIN_NEW_TOKENS, max_len),
+                eos_token_id=tokenizer.eos_token_id,
+                num_return_sequences=num_poems
+            ), skip_special_tokens=True)
+            for prompt, num_poems in requests
+        ]
+
+    # A request's path and random stream depend only on the request itself, so its seed reproduces its poems
+    # regardless of what else shares the batch: single-poem requests use speculative decoding (when a
+    # draft model is loaded), and all other rows are sampled together, each request from its own seeded generator.
+    use_draft = generator["draft_model"] is not None
+    texts = {}
+    for index, (prompt, num_poems) in enumerate(requests):
+        if not (use_draft and num_poems == 1):
+            continue
+        # Assisted generation only verifies a single sequence, so it runs once per single-poem request
+        set_seed(seed_value) # Set seed for reproducibility
+        input_ids = torch.tensor([prompt], device=device)
+        output_ids = model.generate(
+            input_ids,
+            assistant_model=generator["draft_model"],
+            # generate() appends to the cache it is given, so each call works on its own copy
+            past_key_values=copy.deepcopy(generator["prefix_past"]),
+            use_cache=True,
+            max_new_tokens=max_len,
+            min_new_tokens=min(MIN_NEW_TOKENS, max_len),
+            do_sample=True,
+            temperature=temperature,
+            top_k=50,
+            top_p=0.95,
             no_repeat_ngram_size=2,
-            early_stopping=True,
-            temperature=temperature
+            stopping_criteria=StoppingCriteriaList([StanzaStoppingCriteria(input_ids.shape[1], generator["stanza_tables"])]),
+            pad_token_id=tokenizer.pad_token_id
         )
+        texts[index] = tokenizer.batch_decode(output_ids[:, input_ids.shape[1]:], skip_special_tokens=True)
+
+    batched = [(index, prompt, num_poems) for index, (prompt, num_poems) in enumerate(requests) if index not in texts]
+    if batched:
+        prompts, row_generators = [], []
+        for _, prompt, num_poems in batched:
+            request_generator = torch.Generator(device=device).manual_seed(seed_value)
+            prompts.extend([prompt] * num_poems)
+            row_generators.extend([request_generator] * num_poems)
+        # Left padding moves the shared prefix away from position 0, so the prefix cache can't be reused here
+        # tokenizer.pad() prepends padding with list concatenation, so the tuple prompts are converted first
+        inputs = tokenizer.pad({"input_ids": [list(prompt) for prompt in prompts]}, return_tensors="pt").to(device)
+        logits_processor = LogitsProcessorList([
+            MinNewTokensLengthLogitsProcessor(
+                inputs.input_ids.shape[1], min(MIN_NEW_TOKENS, max_len), tokenizer.eos_token_id, device=device
+            ),
+            NoRepeatNGramLogitsProcessor(2),
+            TemperatureLogitsWarper(temperature),
+            TopKLogitsWarper(50),
+            TopPLogitsWarper(0.95),
+        ])
+        generated = _sample_generate(
+            model,
+            inputs.input_ids,
+            inputs.attention_mask,
+            logits_processor,
+            max_new_tokens=max_len,
+            eos_token_id=tokenizer.eos_token_id,
+            tables=generator["stanza_tables"],
+            row_generators=row_generators
+        )
+        decoded = iter(tokenizer.batch_decode(generated, skip_special_tokens=True))
+        for index, _, num_poems in batched:
+            texts[index] = [next(decoded) for _ in range(num_poems)]
+
+    return [texts[index] for index in range(len(requests))]
+
+
+def _batch_worker(generator):
+    """
+    Collects queued (prompt, params, num_poems, future) requests for a short window and runs them as one batch.
+    A request's poems are never split across batches, so a batch can overshoot the row cap by one request.
+    A None entry in the queue shuts the worker down after the requests collected so far are served.
+    """
+    request_queue = generator["queue"]
+    max_rows = VLLM_MAX_NUM_SEQS if generator["backend"] == "vllm" else MAX_BATCH_SIZE
+    shutting_down = False
+    while not shutting_down:
+        batch = [request_queue.get()]
+        rows = 0 if batch[0] is None else batch[0][2]
+        deadline = time.monotonic() + BATCH_WINDOW_SECONDS
+        while batch[-1] is not None and rows < max_rows:
+            try:
+                batch.append(request_queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+            if batch[-1] is not None:
+                rows += batch[-1][2]
+        if batch[-1] is None:
+            shutting_down = True
+            batch.pop()
+
+        # Only requests with identical sampling parameters can share a generate call,
+        # except under vLLM, which takes sampling parameters per request
+        groups = {}
+        for request in batch:
+            groups.setdefault(None if generator["backend"] == "vllm" else request[1], []).append(request)
+        for requests in groups.values():
+            try:
+                if generator["backend"] == "vllm":
+                    results = _generate_vllm(generator, [(prompt, params, num_poems) for prompt, params, num_poems, _ in requests])
+                else:
+                    results = _generate_batch(generator, [(prompt, num_poems) for prompt, _, num_poems, _ in requests], *requests[0][1])
+            except Exception as e:
+                for *_, future in requests:
+                    future.set_exception(e)
+            else:
+                for (*_, future), texts in zip(requests, results):
+                    future.set_result(texts)
+
+
+def _warm_up(generator):
+    """
+    Runs a couple of tiny generations through the queue (one single-row batch, one two-row batch)
+    so kernel autotuning and torch.compile happen at load time, not on the first click.
+    The two-row batch uses prompts of different lengths so the padding path is exercised as well.
+    """
+    tokenizer = generator["tokenizer"]
+    warmup_prompts = [
+        tuple(generator["prefix_ids"] + tokenizer(topic).input_ids + generator["suffix_ids"])
+        for topic in (" rain", " a quiet winter morning")
+    ]
+    warmup_params = (2, 0.7, 0, 1) # max_len, temperature, seed_value, num_beams
+    for prompts in (warmup_prompts[:1], warmup_prompts):
+        futures = [Future() for _ in prompts]
+        for prompt, future in zip(prompts, futures):
+            generator["queue"].put((prompt, warmup_params, 1, future))
+        for future in futures:
+            future.result()
 
-        poems = []
-        for i, output in enumerate(generated_texts):
-            poem_text = output['generated_text'][len(prompt):].strip()
-            poem_text = poem_text.split("\n\n")[0]
-            # You can choose to keep or remove the "--- Poem X ---" prefix
-            # For a cleaner UI, you might just return the poem_text directly
-            # poems.append(f"--- Poem {i+1} ---\n{poem_text}")
-            poems.append(poem_text) # Returning just the poem text
 
-        return poems
+# --- Your Original Poem Generation Logic (slightly adapted) ---
+def generate_poem_for_streamlit(generator_pipeline, topic, max_len=60, num_poems=1, temperature=0.7, num_beams=1, seed_value=42):
+    """
+    Generates poem(s) by submitting the request to the shared batching queue.
+    With num_beams=1 poems are sampled; single-row batches then use speculative decoding when
+    a draft model is loaded: the draft model proposes tokens and the main model accepts or rejects them.
+    With num_beams>1 poems come from beam search.
+    Returns a list of poem strings.
+    """
+    unavailable = ["Error: Model pipeline not available (another model may have been selected meanwhile)."]
+    if generator_pipeline is None or generator_pipeline.get("closed", True):
+        return unavailable
+
+    try:
+        # Only the topic is tokenized per request; the fixed parts of the prompt were tokenized at load time
+        prompt = tuple(
+            generator_pipeline["prefix_ids"]
+            + generator_pipeline["tokenizer"](" " + topic.strip()).input_ids
+            + generator_pipeline["suffix_ids"]
+        )
+        params = (max_len, temperature, seed_value, num_beams)
+        # All poems of a request travel as one queue entry, so they are always generated in the same batch
+        future = Future()
+        with generator_pipeline["lock"]:
+            if generator_pipeline["closed"]:
+                return unavailable
+            generator_pipeline["queue"].put((prompt, params, num_poems, future))
+
+        # The worker already sliced off the prompt tokens and batch-decoded the rest; keep only the first stanza.
+        # The "--- Poem X ---" headers are added by the UI, so just the poem text is returned.
+        return [text.strip().split("\n\n")[0] for text in future.result()]
 
     except Exception as e:
         return [f"Error generating poem: {e}"]
 
 # --- Streamlit User Interface ---
+def _request_model_switch():
+    """Marks that the user picked a model in this session, so this run switches the shared model."""
+    st.session_state["model_switch_requested"] = True
+
+
 st.set_page_config(page_title="AI Poem Generator", layout="wide")
 st.title("✒️ Generative AI Poem Creator")
 st.markdown("Enter a topic below and let the AI craft a poem for you!")
@@ -68,15 +776,36 @@ st.markdown("Enter a topic below and let the AI craft a poem for you!")
 # --- Sidebar for Controls (Optional but good for organization) ---
 with st.sidebar:
     st.header("⚙️ Controls")
-    # For this direct conversion, we'll keep model fixed, but you could add a selectbox
-    # model_choice = st.selectbox("Choose Model", ("gpt2", "gpt2-medium")) # Example
-    model_name_to_load = "gpt2" # Keeping it simple as per original script
+    # Larger models spill over to CPU RAM when they don't fit on the GPU. vLLM reserves most of the GPU
+    # for a single engine, so switching models is disabled on that backend.
+    # All sessions share one model: unless the user just changed the selection, show the resident model
+    # rather than reloading whatever this session picked earlier.
+    resident_models = list(_active_generators())
+    if resident_models and not st.session_state.pop("model_switch_requested", False):
+        st.session_state["model_choice"] = resident_models[0]
+    model_name_to_load = st.selectbox(
+        "Choose Model",
+        ("gpt2", "gpt2-medium", "gpt2-large"),
+        key="model_choice",
+        on_change=_request_model_switch,
+        disabled=_select_backend("cuda" if torch.cuda.is_available() else "cpu") == "vllm"
+    )
 
     # We can make other parameters interactive later if desired
     max_len_param = st.slider("Max Poem Length (approx words):", 30, 150, 60, 10)
     temp_param = st.slider("Creativity (Temperature):", 0.5, 1.0, 0.7, 0.05)
     num_poems_param = st.number_input("Number of Poems to Generate:", 1, 5, 1)
     seed_param = st.number_input("Seed (for reproducibility):", 0, 1000, 42)
+    num_beams_param = st.number_input("Beam Width (1 = sampling):", 1, 8, 1)
+
+
+# Load the model (and warm it up) before any click; it is cached after the first run for this model_name
+with st.spinner(f"Loading AI model ({model_name_to_load})... This might take a moment on first run."):
+    active_pipeline = load_generator_pipeline(model_name=model_name_to_load)
+    if active_pipeline is not None and active_pipeline.get("closed", True):
+        # The cached entry was shut down for a model switch whose load then failed; drop it and load again
+        load_generator_pipeline.clear()
+        active_pipeline = load_generator_pipeline(model_name=model_name_to_load)
 
 
 # --- Main Page ---
@@ -85,10 +814,6 @@ user_topic = st.text_input("Enter a topic for your poem (e.g., 'the ocean', 'a l
 # Button to trigger poem generation
 if st.button("✨ Generate Poem ✨", type="primary"):
     if user_topic:
-        # Load the model (it will be cached after the first run for this model_name)
-        with st.spinner(f"Loading AI model ({model_name_to_load})... This might take a moment on first run."):
-            active_pipeline = load_generator_pipeline(model_name=model_name_to_load)
-
         if active_pipeline:
             with st.spinner(f"AI is composing your poem(s) about '{user_topic}'..."):
                 generated_poems = generate_poem_for_streamlit(
@@ -97,7 +822,7 @@ if st.button("✨ Generate Poem ✨", type="primary"):
                     max_len=max_len_param,
                     num_poems=num_poems_param,
                     temperature=temp_param,
-                    num_beams=5, # Kept fixed from original, could be a slider
+                    num_beams=num_beams_param,
                     seed_value=seed_param
                 )
 